@@ -1,4 +1,8 @@
 from rich.console import Console
+from rich.console import Group
+from rich.console import RenderableType
+from rich.pretty import Pretty
+from rich.text import Text
 
 from llm_reflection import GoogleParams
 from llm_reflection import LlmReflection
@@ -6,6 +10,25 @@ from llm_reflection import PrompTemplate
 
 console = Console()
 
+RECIPE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "ingredients": {"type": "array", "items": {"type": "string"}},
+        "steps": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["title", "ingredients", "steps"],
+    "additionalProperties": False,
+}
+
+
+def print_result(result: str, history: list[str] | None = None):
+    renderables: list[RenderableType] = []
+    if history is not None:
+        renderables += [Text("*" * 30), Text("History"), Pretty(history)]
+    renderables += [Text("*" * 30), Text(result)]
+    console.print(Group(*renderables))
+
 
 def example_translation():
     source_lang = "english"
@@ -43,11 +66,10 @@ def example_translation():
         ],
     )
 
-    console.print("*" * 10)
-    console.print(translation)
+    console.print(Group(Text("*" * 10), Text(translation)))
 
 
-def example_recipe():
+def example_recipe_stream():
     country = "Mexico"
     ingredients = ["rice", "meat", "vegetables"]
 
@@ -55,7 +77,29 @@ def example_recipe():
         person=f"You are an expert cooking and the best chef. Create recipes with these food ingredients.\
                     You are from {country}",
         task=f"""Create 1 recipe with these food ingredients: {ingredients}""",
-        output_format="JSON",
+    )
+
+    llm_reflection = LlmReflection(
+        GoogleParams(model_name="gemini-1.5-flash", temperature=0.8),
+        system_message=f"You are an expert cooking and the best chef. Create recipes with these food ingredients.\
+                    You are from {country}",
+    )
+
+    console.print("*" * 30)
+    for chunk in llm_reflection.generate_text_stream(prompt):
+        console.print(chunk, end="")
+    console.print()
+
+
+def example_recipe(verbose: bool = False):
+    country = "Mexico"
+    ingredients = ["rice", "meat", "vegetables"]
+
+    prompt = PrompTemplate(
+        person=f"You are an expert cooking and the best chef. Create recipes with these food ingredients.\
+                    You are from {country}",
+        task=f"""Create 1 recipe with these food ingredients: {ingredients}""",
+        response_schema=RECIPE_SCHEMA,
     )
 
     llm_reflection = LlmReflection(
@@ -75,14 +119,10 @@ def example_recipe():
         ],
     )
 
-    console.print("*" * 30)
-    console.print("History")
-    console.print(llm_reflection.history)
-    console.print("*" * 30)
-    console.print(recipe)
+    print_result(recipe, llm_reflection.history if verbose else None)
 
 
-def example_recipe_without_reflection_point():
+def example_recipe_without_reflection_point(verbose: bool = False):
     country = "Mexico"
     ingredients = ["rice", "meat", "vegetables"]
 
@@ -90,7 +130,7 @@ def example_recipe_without_reflection_point():
         person=f"You are an expert cooking and the best chef. Create recipes with these food ingredients.\
                     You are from {country}",
         task=f"""Create 1 recipe with these food ingredients: {ingredients}""",
-        output_format="JSON",
+        response_schema=RECIPE_SCHEMA,
     )
 
     llm_reflection = LlmReflection(
@@ -101,12 +141,8 @@ def example_recipe_without_reflection_point():
 
     recipe = llm_reflection.generate_text(prompt)
 
-    console.print("*" * 30)
-    console.print("History")
-    console.print(llm_reflection.history)
-    console.print("*" * 30)
-    console.print(recipe)
+    print_result(recipe, llm_reflection.history if verbose else None)
 
 
 if __name__ == "__main__":
-    example_recipe_without_reflection_point()
+    example_recipe_without_reflection_point(verbose=True)
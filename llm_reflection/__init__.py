@@ -1,5 +1,7 @@
+from .llm_reflection import CircuitOpenError
 from .llm_reflection import GoogleParams
 from .llm_reflection import LlmReflection
 from .llm_reflection import OpenAIParams
 from .llm_reflection import PrompTemplate
 from .llm_reflection import ProviderParams
+from .llm_reflection import register_provider
@@ -1,14 +1,83 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+import warnings
+import weakref
+from collections import deque
 from dataclasses import dataclass
+from dataclasses import field
+from functools import lru_cache
+from io import StringIO
+from typing import Any
+from typing import AsyncIterator
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
 
-from langchain_google_vertexai import VertexAI
-from langchain_openai import OpenAI
+from google.api_core import exceptions as google_exceptions
+from langchain_core.caches import BaseCache
+from langchain_core.outputs import Generation
+from openai import APITimeoutError
+from openai import AsyncOpenAI
+from openai import InternalServerError
+from openai import OpenAI
+from openai import RateLimitError
 from rich.console import Console
+from tenacity import AsyncRetrying
+from tenacity import RetryCallState
+from tenacity import Retrying
+from tenacity import retry_if_exception_type
+from tenacity import stop_after_attempt
+from tenacity import wait_random_exponential
+from vertexai.generative_models import GenerationConfig
+from vertexai.generative_models import GenerativeModel
 
 console = Console()
+logger = logging.getLogger(__name__)
 
+MAX_PARALLEL_ENV = "LLM_REFLECTION_MAX_PARALLEL"
+DEFAULT_MAX_PARALLEL = 4
+CACHE_MAX_TEMPERATURE = 0.3
+DEFAULT_MAX_BATCH = 8
+DEFAULT_HISTORY_MAX = 32
+SPECULATION_MIN_COVERAGE = 0.9
+RETRY_ATTEMPTS = 4
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_OPEN_SECONDS = 30.0
 
-@dataclass
+# Transient provider errors (rate limits, timeouts and 5xx) that are retried.
+_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    RateLimitError,
+    APITimeoutError,
+    InternalServerError,
+    TimeoutError,
+)
+
+_BATCH_ANSWER_PATTERN = re.compile(r"<ANSWER id=(\d+)>(.*?)</ANSWER>", re.S)
+_REVISION_RATE_PATTERN = re.compile(r"\s*(\d+)\s*")
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised without calling the provider while its circuit breaker is open,
+    after CIRCUIT_FAILURE_THRESHOLD consecutive LLM calls failed with
+    transient errors. It is chained to the last provider error.
+    """
+
+
+@dataclass(slots=True, frozen=True)
 class ProviderParams:
     """
     Base class for provider parameters.
@@ -22,7 +91,7 @@ class ProviderParams:
     temperature: float
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class OpenAIParams(ProviderParams):
     """
     Parameters for OpenAI models.
@@ -38,12 +107,12 @@ class OpenAIParams(ProviderParams):
     openai_organization: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class GoogleParams(ProviderParams):
     pass
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class PrompTemplate:
     """
     A class to represent a prompt template.
@@ -53,204 +122,1614 @@ class PrompTemplate:
         task (str): The task to be performed by the LLM.
         context (str): Additional context for the LLM.
         output_format (str): The desired output format for the LLM.
+        response_schema (Dict[str, Any], optional): A JSON schema that the generated text must
+            follow. It is enforced with the structured output of the provider, so the generated
+            text is always a JSON document. With OpenAI the schema must follow the strict mode
+            rules, e.g. every object lists all its properties as required and sets
+            "additionalProperties": false. Defaults to None.
+        prompt_text (str): The prompt sent to the LLM to generate the first text.
     """
 
     person: str
     task: str
     context: str = ""
     output_format: str = ""
+    response_schema: Optional[Dict[str, Any]] = field(default=None, hash=False)
+    prompt_text: str = field(init=False, repr=False, compare=False)
 
-    @property
-    def prompt_text(self):
-        return self.person + self.task + self.context + self.output_format
+    def __post_init__(self):
+        object.__setattr__(
+            self,
+            "prompt_text",
+            "".join((self.person, self.task, self.context, self.output_format)),
+        )
 
 
-class LlmReflection:
+def _read_max_parallel() -> int:
     """
-    A class to represent a LLM reflection object.
+    Reads the maximum number of concurrent async LLM calls from the
+    LLM_REFLECTION_MAX_PARALLEL env var, falling back to DEFAULT_MAX_PARALLEL
+    when it is not set or is not a positive integer.
+
+    Returns:
+        int: The maximum number of concurrent async LLM calls.
+    """
+    value = os.environ.get(MAX_PARALLEL_ENV)
+    if value is None:
+        return DEFAULT_MAX_PARALLEL
+
+    try:
+        max_parallel = int(value)
+    except ValueError:
+        max_parallel = 0
+
+    if max_parallel < 1:
+        warnings.warn(
+            f"{MAX_PARALLEL_ENV}={value!r} is not a positive integer, "
+            f"using {DEFAULT_MAX_PARALLEL}"
+        )
+        return DEFAULT_MAX_PARALLEL
+    return max_parallel
+
+
+MAX_PARALLEL = _read_max_parallel()
+
+_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _llm_call_limiter() -> asyncio.Semaphore:
+    """
+    Returns the semaphore that caps the async LLM calls of the running event
+    loop to MAX_PARALLEL, shared by all the LlmReflection instances.
+
+    Returns:
+        asyncio.Semaphore: The limiter of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = asyncio.Semaphore(MAX_PARALLEL)
+    return limiter
+
+
+@dataclass(slots=True)
+class _CircuitBreaker:
+    """
+    Stops calling a provider for CIRCUIT_OPEN_SECONDS after
+    CIRCUIT_FAILURE_THRESHOLD consecutive LLM calls failed with transient
+    errors. A call fails once its retries are exhausted, so the retries of a
+    single call never open the circuit.
 
     Attributes:
-        providerParams (ProviderParams): The parameters for the LLM provider.
-        system_message (str): The system message for the LLM.
+        open_until (float): The time.monotonic() until the circuit is open.
+        consecutive_failures (int): The number of failed calls in a row.
+        last_error (BaseException, optional): The error of the last failed call.
     """
 
-    def __init__(self, providerParams: ProviderParams, system_message: str):
-        self.system_message = system_message
-        self.llm = self._create_llm(providerParams, system_message)
-        self._history: List[str] = []
+    open_until: float = 0.0
+    consecutive_failures: int = 0
+    last_error: Optional[BaseException] = None
 
-    @property
-    def history(self) -> List[str]:
-        """
-        Returns the history of LLM interactions.
+    def check(self) -> None:
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(
+                f"The provider circuit is open for {remaining:.1f} more seconds"
+            ) from self.last_error
 
-        Returns:
-            List[str]: The history of LLM interactions.
-        """
-        return self._history
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
 
-    def generate_text(self, prompt: PrompTemplate, reflection_items: List = []) -> str:
-        """
-        Generates text using the LLM with reflection.
+    def record_failure(self, error: BaseException) -> None:
+        self.last_error = error
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.consecutive_failures = 0
+            self.open_until = time.monotonic() + CIRCUIT_OPEN_SECONDS
+            logger.warning(
+                "opened the provider circuit for %.0f seconds after %r",
+                CIRCUIT_OPEN_SECONDS,
+                error,
+            )
 
-        Args:
-            prompt (PrompTemplate): The prompt template to use.
-            reflection_items (List, optional): A list of reflection items to consider. Defaults to [].
 
-        Returns:
-            str: The generated text.
-        """
-        self._history = []
+_circuit_breakers: Dict[type, _CircuitBreaker] = {}
 
-        reflection_items_prompt = ""
-        for index, item in enumerate(reflection_items):
-            reflection_items_prompt += f"""
-                {index + 1}. {item} \n
-            """
 
-        first_text = self._generate_first_text(prompt)
-        reflection = self._generate_reflection(
-            prompt, first_text, reflection_items_prompt
-        )
-        return self._generate_improve_text(
-            prompt, first_text, reflection, reflection_items_prompt
+def _circuit_breaker(llm: Any) -> _CircuitBreaker:
+    """
+    Returns the circuit breaker of the provider of an LLM object, shared by all
+    the LlmReflection instances that use the same provider.
+
+    Args:
+        llm (Any): The LLM object.
+
+    Returns:
+        _CircuitBreaker: The circuit breaker of the provider.
+    """
+    return _circuit_breakers.setdefault(type(llm), _CircuitBreaker())
+
+
+def _guarded_invoke(
+    llm: Any, prompt: str, response_schema: Optional[Dict[str, Any]]
+) -> str:
+    _circuit_breaker(llm).check()
+    return llm.invoke(prompt, **_schema_kwargs(response_schema))
+
+
+def _guarded_stream(
+    llm: Any, prompt: str, response_schema: Optional[Dict[str, Any]]
+) -> Iterator[str]:
+    breaker = _circuit_breaker(llm)
+    breaker.check()
+    try:
+        yield from llm.stream(prompt, **_schema_kwargs(response_schema))
+    except _RETRYABLE_ERRORS as error:
+        breaker.record_failure(error)
+        raise
+    breaker.record_success()
+
+
+async def _guarded_astream(
+    llm: Any, prompt: str, response_schema: Optional[Dict[str, Any]]
+) -> AsyncIterator[str]:
+    breaker = _circuit_breaker(llm)
+    breaker.check()
+    try:
+        async for chunk in llm.astream(prompt, **_schema_kwargs(response_schema)):
+            yield chunk
+    except _RETRYABLE_ERRORS as error:
+        breaker.record_failure(error)
+        raise
+    breaker.record_success()
+
+
+@dataclass(slots=True)
+class _InFlightCall:
+    """
+    An async LLM call shared by all the callers that send the same prompt
+    while it is running.
+
+    Attributes:
+        task (asyncio.Task): The task that calls the LLM.
+        waiters (int): The number of callers waiting for the task.
+    """
+
+    task: asyncio.Task
+    waiters: int = 0
+
+
+_in_flight_calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[int, str, Optional[str]], _InFlightCall]]" = weakref.WeakKeyDictionary()
+
+
+def _schema_key(response_schema: Optional[Dict[str, Any]]) -> Optional[str]:
+    if response_schema is None:
+        return None
+    return json.dumps(response_schema, sort_keys=True)
+
+
+def _schema_kwargs(response_schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # Only pass the schema when it is set, so the registered providers without
+    # structured output support keep working for the other prompts.
+    if response_schema is None:
+        return {}
+    return {"response_schema": response_schema}
+
+
+async def _limited_ainvoke(
+    llm: Any, prompt: str, response_schema: Optional[Dict[str, Any]]
+) -> str:
+    _circuit_breaker(llm).check()
+    async with _llm_call_limiter():
+        return await llm.ainvoke(prompt, **_schema_kwargs(response_schema))
+
+
+async def _coalesced_ainvoke(
+    llm: Any, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    Calls the LLM asynchronously, sharing the call with the other callers that
+    send the same prompt to the same LLM object while it is running, and
+    capping the running calls with _llm_call_limiter. The call is cancelled
+    only when all its callers are cancelled.
+
+    Args:
+        llm (Any): The LLM object.
+        prompt (str): The prompt to send.
+        response_schema (Dict[str, Any], optional): The JSON schema of the response. Defaults
+            to None.
+
+    Returns:
+        str: The LLM response.
+    """
+    loop = asyncio.get_running_loop()
+    calls = _in_flight_calls.get(loop)
+    if calls is None:
+        calls = _in_flight_calls[loop] = {}
+
+    key = (id(llm), prompt, _schema_key(response_schema))
+    call = calls.get(key)
+    if call is None:
+        call = calls[key] = _InFlightCall(
+            asyncio.ensure_future(_limited_ainvoke(llm, prompt, response_schema))
         )
+        call.task.add_done_callback(lambda _: calls.pop(key, None))
 
-    def _generate_first_text(self, prompt: PrompTemplate) -> str:
-        result = self._llm_invoke(prompt.prompt_text)
-        self._history.append(result)
-        return result
+    call.waiters += 1
+    try:
+        return await asyncio.shield(call.task)
+    except asyncio.CancelledError:
+        if call.waiters == 1:
+            call.task.cancel()
+        raise
+    finally:
+        call.waiters -= 1
 
-    def _generate_reflection(
-        self,
-        prompt: PrompTemplate,
-        first_text: str,
-        reflection_items_prompt: str,
-    ) -> str:
-        """
-        Generates reflection suggestions from the LLM.
 
-        Args:
-            prompt (PrompTemplate): The prompt template to use.
-            first_text (str): The first generated text.
-            reflection_items_prompt (str): The prompt for reflection items.
+def _dedupe_reflection_items(reflection_items: List) -> List:
+    """
+    Removes the repeated reflection items, keeping the order of their first
+    appearance. The whitespace of the items is normalized, so items that only
+    differ in spaces or line breaks are considered the same.
 
-        Returns:
-            str: The reflection suggestions.
-        """
+    Args:
+        reflection_items (List): The reflection items to consider.
 
-        if reflection_items_prompt != "":
-            prompt_reflection = f"""
-                you are {prompt.person} and then give constructive criticism and helpful suggestions to improve the following task
-                {prompt.task}
+    Returns:
+        List: The reflection items without duplicates.
+    """
+    seen = set()
+    items = []
+    for item in reflection_items:
+        item = " ".join(item.split())
+        if item not in seen:
+            seen.add(item)
+            items.append(item)
 
-                The first result delimited by XML tags <FIRST_RESULT></FIRST_RESULT> is the follow:
-                <FIRST_RESULT>
-                {first_text}
-                </FIRST_RESULT>
+    if len(items) < len(reflection_items):
+        logger.info("deduped %d reflection items", len(reflection_items) - len(items))
+    return items
+
+
+@lru_cache(maxsize=128)
+def _build_reflection_items_prompt(reflection_items: Tuple[str, ...]) -> str:
+    """
+    Builds the numbered list of reflection items, shared by all the calls that
+    use the same reflection items.
+
+    Args:
+        reflection_items (Tuple[str, ...]): The reflection items to consider.
+
+    Returns:
+        str: The prompt for reflection items.
+    """
+    return "\n".join(
+        f"{index + 1}. {item}" for index, item in enumerate(reflection_items)
+    )
+
+
+@lru_cache(maxsize=128)
+def _reflection_prompt_prefix(
+    person: str, task: str, reflection_items_prompt: str
+) -> str:
+    """
+    Builds the static part of the reflection prompt. It does not depend on the
+    generated text, so it is sent as a stable prefix that provider-side prompt
+    caches can reuse between calls.
+
+    Args:
+        person (str): The persona of the LLM.
+        task (str): The task to be performed by the LLM.
+        reflection_items_prompt (str): The prompt for reflection items.
+
+    Returns:
+        str: The static prefix of the reflection prompt.
+    """
+    if reflection_items_prompt != "":
+        return f"""
+                you are {person} and then give constructive criticism and helpful suggestions to improve the following task
+                {task}
 
                 When writing suggestions, pay attention to whether there are ways to improve \n\
                 {reflection_items_prompt}
 
-                Write a list of specific, helpful and constructive suggestions for improving the {prompt.task}.
-                Output only the suggestions and nothing else.
+                Write a list of specific, helpful and constructive suggestions for improving the {task}.
             """
-        else:
-            prompt_reflection = f"""
-                you are {prompt.person} and then give constructive criticism and helpful suggestions to improve the following task
-                {prompt.task}
 
-                The first result delimited by XML tags <FIRST_RESULT></FIRST_RESULT> is the follow:
-                <FIRST_RESULT>
-                {first_text}
-                </FIRST_RESULT>
+    return f"""
+                you are {person} and then give constructive criticism and helpful suggestions to improve the following task
+                {task}
 
                 When writing suggestions, first define four reflection points for this task and pay attention to whether there are ways to improve \n\
 
-                Write a list of specific, helpful and constructive suggestions for improving the {prompt.task}.
-                Output only the suggestions and nothing else.
+                Write a list of specific, helpful and constructive suggestions for improving the {task}.
             """
 
-        result = self._llm_invoke(prompt_reflection)
-        self._history.append(result)
-        return result
 
-    def _generate_improve_text(
-        self,
-        prompt: PrompTemplate,
-        first_text: str,
-        expert_suggestions: str,
-        reflection_items_prompt: str,
-    ) -> str:
-        """
-        Generates improved text based on reflection suggestions.
+@lru_cache(maxsize=128)
+def _reflection_item_prompt_prefix(person: str, task: str) -> str:
+    """
+    Builds the static part of the single reflection item prompt. The item is
+    appended after the generated text, so the calls for every item of the
+    same draft share the whole prefix.
 
-        Args:
-            prompt (PrompTemplate): The prompt template to use.
-            first_text (str): The first generated text.
-            expert_suggestions (str): The reflection suggestions.
-            reflection_items_prompt (str): The prompt for reflection items.
+    Args:
+        person (str): The persona of the LLM.
+        task (str): The task to be performed by the LLM.
 
-        Returns:
-            str: The improved text.
-        """
+    Returns:
+        str: The static prefix of the single reflection item prompt.
+    """
+    return f"""
+                you are {person} and then give constructive criticism and helpful suggestions to improve the following task
+                {task}
 
-        prompt_improve_text = f"""
-            Your task is to carefully read, then edit, a {prompt.task}, taking into
-            account a list of expert suggestions and constructive criticisms.
+                Write a list of specific, helpful and constructive suggestions for improving the {task}.
+            """
 
-            The first result delimited by XML tags <FIRST_RESULT></FIRST_RESULT> is the follow:
-            <FIRST_RESULT>
-            {first_text}
-            </FIRST_RESULT>,
 
-            and the expert suggestions are delimited by XML tags <EXPERT_SUGGESTIONS></EXPERT_SUGGESTIONS> \
-            as follows:
+@lru_cache(maxsize=128)
+def _improve_text_prompt_prefix(task: str, reflection_items_prompt: str) -> str:
+    """
+    Builds the static part of the improve text prompt, see
+    _reflection_prompt_prefix.
+
+    Args:
+        task (str): The task to be performed by the LLM.
+        reflection_items_prompt (str): The prompt for reflection items.
 
-            <EXPERT_SUGGESTIONS>
-            {expert_suggestions}
-            </EXPERT_SUGGESTIONS>
+    Returns:
+        str: The static prefix of the improve text prompt.
+    """
+    return f"""
+            Your task is to carefully read, then edit, a {task}, taking into
+            account a list of expert suggestions and constructive criticisms.
 
-            Please take into account the expert suggestions when you are doing {prompt.task}. Edit the first result by ensuring:
+            Please take into account the expert suggestions when you are doing {task}. Edit the first result by ensuring:
             {reflection_items_prompt}
+        """
+
+
+def _build_revision_rate_prompt(
+    task: str, reflection_items_prompt: str, first_text: str
+) -> str:
+    """
+    Builds the prompt used to ask the LLM how much the first text needs
+    revision.
+
+    Args:
+        task (str): The task to be performed by the LLM.
+        reflection_items_prompt (str): The prompt for reflection items.
+        first_text (str): The first generated text.
+
+    Returns:
+        str: The revision rate prompt.
+    """
+    criteria = reflection_items_prompt or task
+    return f"""
+            Rate from 1 to 10 how much the following result needs revision for:
+            {criteria}
 
-            Output only the new result and nothing else
+            The result is delimited by XML tags <DRAFT></DRAFT>:
+            <DRAFT>
+            {first_text}
+            </DRAFT>
+
+            Reply with one integer and nothing else.
         """
 
-        result = self._llm_invoke(prompt_improve_text)
-        self._history.append(result)
-        return result
 
-    def _llm_invoke(
-        self,
-        prompt: str,
-    ) -> str:
-        return self.llm.invoke(prompt)
+def _build_summary_prompt(text: str) -> str:
+    """
+    Builds the prompt used to ask the LLM for a summary of a long text.
 
-    def _create_llm(
-        self,
-        providerParams: ProviderParams,
-        system_message: str,
-    ) -> VertexAI | OpenAI:
+    Args:
+        text (str): The text to summarize.
+
+    Returns:
+        str: The summary prompt.
+    """
+    return f"""
+            Summarize the following text delimited by XML tags <TEXT></TEXT> in about 300 tokens,
+            preserving all its factual content:
+            <TEXT>
+            {text}
+            </TEXT>
+
+            Output only the summary and nothing else.
         """
-        Creates the LLM object based on the provider parameters.
 
-        Args:
-            providerParams (ProviderParams): The parameters for the LLM provider.
-            system_message (str): The system message for the LLM.
 
-        Returns:
-            VertexAI | OpenAI: The LLM object.
+def _build_batch_prompt(prompts: List[str]) -> str:
+    """
+    Builds a single prompt that asks the LLM to answer several independent
+    prompts, each one identified by its position.
+
+    Args:
+        prompts (List[str]): The prompts to answer.
+
+    Returns:
+        str: The batch prompt.
+    """
+    queries = "".join(
+        f"""
+            <QUERY id={index}>
+            {prompt}
+            </QUERY>
+        """
+        for index, prompt in enumerate(prompts)
+    )
+    return f"""
+            Answer each one of the following independent queries. The queries are delimited by
+            XML tags <QUERY id=N></QUERY>, where N is the id of the query.
+            {queries}
+            Write the answer of each query delimited by XML tags <ANSWER id=N></ANSWER> with the
+            same id of the query. Output only the answers and nothing else.
         """
 
-        if isinstance(providerParams, OpenAIParams):
-            return OpenAI(
-                openai_api_key=providerParams.openai_api_key,
-                openai_organization=providerParams.openai_organization,
-                model_name=providerParams.model_name,
-                system_message=system_message,
-            )
 
-        return VertexAI(
-            model_name=providerParams.model_name, system_message=system_message
+def _parse_batch_answers(response: str, size: int) -> Optional[List[str]]:
+    """
+    Parses the answers of a batch prompt, see _build_batch_prompt.
+
+    Args:
+        response (str): The response of the LLM to the batch prompt.
+        size (int): The number of prompts in the batch.
+
+    Returns:
+        Optional[List[str]]: The answers in the order of the prompts, or None
+            when the response does not contain exactly one answer per prompt.
+    """
+    answers = {
+        int(index): answer.strip()
+        for index, answer in _BATCH_ANSWER_PATTERN.findall(response)
+    }
+    if sorted(answers) != list(range(size)):
+        return None
+    return [answers[index] for index in range(size)]
+
+
+_FIRST_RESULT_OPEN = """
+                The first result delimited by XML tags <FIRST_RESULT></FIRST_RESULT> is the follow:
+                <FIRST_RESULT>
+                """
+_FIRST_RESULT_CLOSE = """
+                </FIRST_RESULT>
+                """
+_REFLECTION_ITEM_OPEN = """
+                When writing suggestions, pay attention only to whether there are ways to improve
+                """
+_REFLECTION_CLOSE = """
+                Output only the suggestions and nothing else.
+            """
+_EXPERT_SUGGESTIONS_OPEN = """
+                </FIRST_RESULT>,
+
+                and the expert suggestions are delimited by XML tags <EXPERT_SUGGESTIONS></EXPERT_SUGGESTIONS> as follows:
+
+                <EXPERT_SUGGESTIONS>
+                """
+_IMPROVE_TEXT_CLOSE = """
+                </EXPERT_SUGGESTIONS>
+
+                Output only the new result and nothing else
+            """
+
+
+_llm_lock = threading.Lock()
+
+
+_PROVIDER_FACTORIES: Dict[Type[ProviderParams], Callable[[Any, str], Any]] = {}
+
+
+def register_provider(
+    params_type: Type[ProviderParams],
+) -> Callable[[Callable[[Any, str], Any]], Callable[[Any, str], Any]]:
+    """
+    Registers a factory that creates the LLM object for a provider parameters
+    class. The factory receives the provider parameters and the system message
+    and is used for that class and its subclasses without their own factory.
+
+    Args:
+        params_type (Type[ProviderParams]): The provider parameters class.
+
+    Returns:
+        Callable: A decorator that registers the factory.
+    """
+
+    def decorator(
+        factory: Callable[[Any, str], Any],
+    ) -> Callable[[Any, str], Any]:
+        _PROVIDER_FACTORIES[params_type] = factory
+        return factory
+
+    return decorator
+
+
+@register_provider(OpenAIParams)
+class _OpenAILLM:
+    """
+    A LLM object backed by the OpenAI chat completions API.
+
+    Attributes:
+        providerParams (OpenAIParams): The parameters for the OpenAI models.
+        system_message (str): The system message for the LLM.
+    """
+
+    def __init__(self, providerParams: OpenAIParams, system_message: str):
+        self._client = OpenAI(
+            api_key=providerParams.openai_api_key,
+            organization=providerParams.openai_organization,
+        )
+        self._async_client = AsyncOpenAI(
+            api_key=providerParams.openai_api_key,
+            organization=providerParams.openai_organization,
+        )
+        self._model_name = providerParams.model_name
+        self._temperature = providerParams.temperature
+        self._system_message = system_message
+
+    def invoke(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> str:
+        response = self._client.chat.completions.create(
+            **self._request(prompt, response_schema)
+        )
+        return response.choices[0].message.content or ""
+
+    async def ainvoke(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> str:
+        response = await self._async_client.chat.completions.create(
+            **self._request(prompt, response_schema)
+        )
+        return response.choices[0].message.content or ""
+
+    def stream(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> Iterator[str]:
+        for chunk in self._client.chat.completions.create(
+            **self._request(prompt, response_schema), stream=True
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def astream(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[str]:
+        async for chunk in await self._async_client.chat.completions.create(
+            **self._request(prompt, response_schema), stream=True
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _request(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        request: Dict[str, Any] = {
+            "model": self._model_name,
+            "temperature": self._temperature,
+            "messages": [
+                {"role": "system", "content": self._system_message},
+                {"role": "user", "content": prompt},
+            ],
+        }
+        if response_schema is not None:
+            request["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "response",
+                    "schema": response_schema,
+                    "strict": True,
+                },
+            }
+        return request
+
+
+# Vertex AI is also the default provider of any other ProviderParams.
+@register_provider(ProviderParams)
+@register_provider(GoogleParams)
+class _VertexAILLM:
+    """
+    A LLM object backed by the Vertex AI Gemini API.
+
+    Attributes:
+        providerParams (ProviderParams): The parameters for the Vertex AI models.
+        system_message (str): The system message for the LLM.
+    """
+
+    def __init__(self, providerParams: ProviderParams, system_message: str):
+        self._model = GenerativeModel(
+            providerParams.model_name, system_instruction=system_message
+        )
+        self._temperature = providerParams.temperature
+        self._generation_config = GenerationConfig(temperature=self._temperature)
+
+    def invoke(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> str:
+        return self._model.generate_content(
+            prompt, generation_config=self._config(response_schema)
+        ).text
+
+    async def ainvoke(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> str:
+        response = await self._model.generate_content_async(
+            prompt, generation_config=self._config(response_schema)
+        )
+        return response.text
+
+    def stream(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> Iterator[str]:
+        for response in self._model.generate_content(
+            prompt, generation_config=self._config(response_schema), stream=True
+        ):
+            yield response.text
+
+    async def astream(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[str]:
+        async for response in await self._model.generate_content_async(
+            prompt, generation_config=self._config(response_schema), stream=True
+        ):
+            yield response.text
+
+    def _config(self, response_schema: Optional[Dict[str, Any]]) -> GenerationConfig:
+        if response_schema is None:
+            return self._generation_config
+        return GenerationConfig(
+            temperature=self._temperature,
+            response_mime_type="application/json",
+            response_schema=_without_additional_properties(response_schema),
         )
+
+
+def _without_additional_properties(schema: Any) -> Any:
+    # The Vertex AI schema has no additionalProperties field, it is only
+    # needed by the OpenAI strict mode.
+    if isinstance(schema, dict):
+        return {
+            key: _without_additional_properties(value)
+            for key, value in schema.items()
+            if key != "additionalProperties"
+        }
+    if isinstance(schema, list):
+        return [_without_additional_properties(value) for value in schema]
+    return schema
+
+
+@lru_cache(maxsize=32)
+def _create_llm(
+    providerParams: ProviderParams,
+    system_message: str,
+) -> Any:
+    """
+    Creates the LLM object with the factory registered for the provider
+    parameters class. The objects are cached, so the instances with the same
+    parameters share the client and its connection pool.
+
+    Args:
+        providerParams (ProviderParams): The parameters for the LLM provider.
+        system_message (str): The system message for the LLM.
+
+    Returns:
+        Any: The LLM object.
+    """
+    for params_type in type(providerParams).__mro__:
+        factory = _PROVIDER_FACTORIES.get(params_type)
+        if factory is not None:
+            return factory(providerParams, system_message)
+
+    raise ValueError(f"No provider registered for {type(providerParams).__name__}")
+
+
+def _get_llm(providerParams: ProviderParams, system_message: str) -> Any:
+    """
+    Returns the cached LLM object for the provider parameters, creating it
+    once even when several threads ask for it at the same time.
+
+    Args:
+        providerParams (ProviderParams): The parameters for the LLM provider.
+        system_message (str): The system message for the LLM.
+
+    Returns:
+        Any: The LLM object.
+    """
+    with _llm_lock:
+        return _create_llm(providerParams, system_message)
+
+
+class LlmReflection:
+    """
+    A class to represent a LLM reflection object.
+
+    Attributes:
+        providerParams (ProviderParams): The parameters for the LLM provider.
+        system_message (str): The system message for the LLM.
+        cache (BaseCache, optional): A LangChain cache (e.g. InMemoryCache or a
+            semantic cache) for the LLM responses. It is only used when the
+            temperature is lower or equal than CACHE_MAX_TEMPERATURE, because
+            caching responses of a high temperature model would remove the
+            variability requested. Defaults to None.
+        history_max (int, optional): The maximum number of LLM responses kept in
+            the history, the oldest ones are discarded. Defaults to
+            DEFAULT_HISTORY_MAX.
+        summary_threshold (int, optional): When the first text is longer than this number of
+            characters (e.g. 4000), the reflection is done over a summary of it instead of the
+            whole text. The improve step always receives the whole first text. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        providerParams: ProviderParams,
+        system_message: str,
+        cache: Optional[BaseCache] = None,
+        history_max: int = DEFAULT_HISTORY_MAX,
+        summary_threshold: Optional[int] = None,
+    ):
+        self.system_message = system_message
+        self.llm = _get_llm(providerParams, system_message)
+        self._history: Deque[str] = deque(maxlen=history_max)
+        self._summary_threshold = summary_threshold
+        self._cache = cache
+        self._use_cache = (
+            cache is not None and providerParams.temperature <= CACHE_MAX_TEMPERATURE
+        )
+        self._llm_string = "|".join(
+            (
+                type(self.llm).__name__,
+                providerParams.model_name,
+                str(providerParams.temperature),
+                system_message,
+            )
+        )
+
+    @property
+    def history(self) -> List[str]:
+        """
+        Returns the history of LLM interactions.
+
+        Returns:
+            List[str]: The history of LLM interactions.
+        """
+        return list(self._history)
+
+    def generate_text(
+        self,
+        prompt: PrompTemplate,
+        reflection_items: List = [],
+        skip_reflection_threshold: Optional[int] = None,
+    ) -> str:
+        """
+        Generates text using the LLM with reflection.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            reflection_items (List, optional): A list of reflection items to consider. Defaults to [].
+            skip_reflection_threshold (int, optional): When set, the LLM rates from 1 to 10 how much
+                the first text needs revision and, if the rate is lower or equal than this threshold,
+                the first text is returned without reflection. Defaults to None.
+
+        Returns:
+            str: The generated text.
+        """
+        self._history.clear()
+
+        reflection_items = _dedupe_reflection_items(reflection_items)
+        reflection_items_prompt = _build_reflection_items_prompt(
+            tuple(reflection_items)
+        )
+
+        first_text = self._generate_first_text(prompt)
+        if self._skip_reflection(
+            prompt, first_text, reflection_items_prompt, skip_reflection_threshold
+        ):
+            return first_text
+
+        reflection = self._generate_reflection(
+            prompt, first_text, reflection_items_prompt
+        )
+        return self._generate_improve_text(
+            prompt, first_text, reflection, reflection_items_prompt
+        )
+
+    def generate_text_stream(
+        self,
+        prompt: PrompTemplate,
+        reflection_items: List = [],
+        skip_reflection_threshold: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Generates text using the LLM with reflection, streaming the chunks of
+        the improved text as soon as the LLM produces them.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            reflection_items (List, optional): A list of reflection items to consider. Defaults to [].
+            skip_reflection_threshold (int, optional): When set, the LLM rates from 1 to 10 how much
+                the first text needs revision and, if the rate is lower or equal than this threshold,
+                the first text is returned without reflection. Defaults to None.
+
+        Returns:
+            Iterator[str]: The chunks of the generated text.
+        """
+        self._history.clear()
+
+        reflection_items = _dedupe_reflection_items(reflection_items)
+        reflection_items_prompt = _build_reflection_items_prompt(
+            tuple(reflection_items)
+        )
+
+        first_text = self._generate_first_text(prompt)
+        if self._skip_reflection(
+            prompt, first_text, reflection_items_prompt, skip_reflection_threshold
+        ):
+            yield first_text
+            return
+
+        reflection = self._generate_reflection(
+            prompt, first_text, reflection_items_prompt
+        )
+
+        result = StringIO()
+        for chunk in self._llm_stream(
+            self._build_improve_text_prompt(
+                prompt, first_text, reflection, reflection_items_prompt
+            ),
+            prompt.response_schema,
+        ):
+            result.write(chunk)
+            yield chunk
+        self._history.append(result.getvalue())
+
+    def generate_text_batch(
+        self,
+        prompts: List[PrompTemplate],
+        reflection_items: List = [],
+        max_batch: int = DEFAULT_MAX_BATCH,
+    ) -> List[str]:
+        """
+        Generates text for several independent prompts using the LLM with
+        reflection, answering up to max_batch prompts with a single LLM call
+        in each stage. If the LLM response of a batch can not be parsed, the
+        prompts of that batch are sent one by one. The first and improved texts
+        of the prompts with a response_schema are always generated one by one,
+        because the schema can only be enforced on a whole response.
+
+        The history contains the results of every stage for all the prompts,
+        up to the latest history_max of them, so a batch of more than
+        history_max / 3 prompts only keeps the results of the last ones.
+
+        Args:
+            prompts (List[PrompTemplate]): The prompt templates to use.
+            reflection_items (List, optional): A list of reflection items to consider. Defaults to [].
+            max_batch (int, optional): The maximum number of prompts per LLM call. Smaller
+                models degrade with large batches, so use ~8 for them and up to ~32 for larger
+                models. Defaults to DEFAULT_MAX_BATCH.
+
+        Returns:
+            List[str]: The generated texts, in the order of the prompts.
+        """
+        if max_batch < 1:
+            raise ValueError("max_batch must be greater than 0")
+
+        self._history.clear()
+
+        reflection_items = _dedupe_reflection_items(reflection_items)
+        reflection_items_prompt = _build_reflection_items_prompt(
+            tuple(reflection_items)
+        )
+
+        results: List[str] = []
+        for start in range(0, len(prompts), max_batch):
+            batch = prompts[start : start + max_batch]
+
+            response_schemas = [prompt.response_schema for prompt in batch]
+            first_texts = self._llm_invoke_batch(
+                [prompt.prompt_text for prompt in batch], response_schemas
+            )
+            reflections = self._llm_invoke_batch(
+                [
+                    self._build_reflection_prompt(
+                        prompt, first_text, reflection_items_prompt
+                    )
+                    for prompt, first_text in zip(batch, first_texts)
+                ]
+            )
+            results.extend(
+                self._llm_invoke_batch(
+                    [
+                        self._build_improve_text_prompt(
+                            prompt, first_text, reflection, reflection_items_prompt
+                        )
+                        for prompt, first_text, reflection in zip(
+                            batch, first_texts, reflections
+                        )
+                    ],
+                    response_schemas,
+                )
+            )
+        return results
+
+    def _generate_first_text(self, prompt: PrompTemplate) -> str:
+        result = self._llm_invoke(prompt.prompt_text, prompt.response_schema)
+        self._history.append(result)
+        return result
+
+    async def agenerate_text(
+        self,
+        prompt: PrompTemplate,
+        reflection_items: List = [],
+        skip_reflection_threshold: Optional[int] = None,
+        speculate_after: Optional[int] = None,
+    ) -> str:
+        """
+        Asynchronously generates text using the LLM with reflection.
+
+        The three stages run sequentially for a single prompt, but independent
+        prompts can be processed concurrently on the same event loop. Use one
+        LlmReflection instance per concurrent call to keep the history of each
+        call separate, e.g.
+        ``await asyncio.gather(*[r.agenerate_text(p) for r, p in zip(instances, prompts)])``.
+
+        When reflection items are given, each item is reflected on by its own
+        LLM call and the calls run concurrently. The async LLM calls of all the
+        instances are capped to LLM_REFLECTION_MAX_PARALLEL (default 4) at a
+        time.
+
+        With speculate_after, the first text is streamed and the reflection
+        starts as soon as speculate_after characters are received, overlapping
+        with the rest of the first text. The snapshot is always a prefix of the
+        final first text, so the speculative reflection is used if the snapshot
+        has at least SPECULATION_MIN_COVERAGE of its characters, otherwise it
+        is cancelled and sent again. The used reflection may not have seen the
+        last 10% of the first text.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            reflection_items (List, optional): A list of reflection items to consider. Defaults to [].
+            skip_reflection_threshold (int, optional): When set, the LLM rates from 1 to 10 how much
+                the first text needs revision and, if the rate is lower or equal than this threshold,
+                the first text is returned without reflection. Defaults to None.
+            speculate_after (int, optional): The number of characters of the streamed first text
+                after which the reflection starts speculatively, None to wait for the whole first
+                text. Defaults to None.
+
+        Returns:
+            str: The generated text.
+        """
+        self._history.clear()
+
+        reflection_items = _dedupe_reflection_items(reflection_items)
+        reflection_items_prompt = _build_reflection_items_prompt(
+            tuple(reflection_items)
+        )
+
+        first_text, reflection = await self._agenerate_first_text_and_reflection(
+            prompt,
+            reflection_items,
+            reflection_items_prompt,
+            skip_reflection_threshold,
+            speculate_after,
+        )
+        if reflection is None:
+            return first_text
+
+        return await self._agenerate_improve_text(
+            prompt, first_text, reflection, reflection_items_prompt
+        )
+
+    async def agenerate_text_stream(
+        self,
+        prompt: PrompTemplate,
+        reflection_items: List = [],
+        skip_reflection_threshold: Optional[int] = None,
+        speculate_after: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Asynchronously generates text using the LLM with reflection, streaming
+        the chunks of the improved text as soon as the LLM produces them. See
+        agenerate_text.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            reflection_items (List, optional): A list of reflection items to consider. Defaults to [].
+            skip_reflection_threshold (int, optional): When set, the LLM rates from 1 to 10 how much
+                the first text needs revision and, if the rate is lower or equal than this threshold,
+                the first text is returned without reflection. Defaults to None.
+            speculate_after (int, optional): The number of characters of the streamed first text
+                after which the reflection starts speculatively, None to wait for the whole first
+                text. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The chunks of the generated text.
+        """
+        self._history.clear()
+
+        reflection_items = _dedupe_reflection_items(reflection_items)
+        reflection_items_prompt = _build_reflection_items_prompt(
+            tuple(reflection_items)
+        )
+
+        first_text, reflection = await self._agenerate_first_text_and_reflection(
+            prompt,
+            reflection_items,
+            reflection_items_prompt,
+            skip_reflection_threshold,
+            speculate_after,
+        )
+        if reflection is None:
+            yield first_text
+            return
+
+        result = StringIO()
+        async for chunk in self._allm_stream(
+            self._build_improve_text_prompt(
+                prompt, first_text, reflection, reflection_items_prompt
+            ),
+            prompt.response_schema,
+        ):
+            result.write(chunk)
+            yield chunk
+        self._history.append(result.getvalue())
+
+    async def _agenerate_first_text_and_reflection(
+        self,
+        prompt: PrompTemplate,
+        reflection_items: List,
+        reflection_items_prompt: str,
+        skip_reflection_threshold: Optional[int],
+        speculate_after: Optional[int],
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Generates the first text and its reflection suggestions, see
+        agenerate_text.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            reflection_items (List): The reflection items to consider.
+            reflection_items_prompt (str): The prompt for reflection items.
+            skip_reflection_threshold (Optional[int]): The maximum revision rate to skip the
+                reflection, None to never skip it.
+            speculate_after (Optional[int]): The number of characters of the first text after
+                which the reflection starts speculatively, None to not speculate.
+
+        Returns:
+            Tuple[str, Optional[str]]: The first text and the reflection suggestions, None when
+                the reflection is skipped.
+        """
+        snapshot = ""
+        speculation: Optional[asyncio.Task] = None
+        try:
+            if speculate_after is None:
+                first_text = await self._allm_invoke(
+                    prompt.prompt_text, prompt.response_schema
+                )
+            else:
+                text = StringIO()
+                async for chunk in self._allm_stream(
+                    prompt.prompt_text, prompt.response_schema
+                ):
+                    text.write(chunk)
+                    if speculation is None and text.tell() >= speculate_after:
+                        snapshot = text.getvalue()
+                        speculation = asyncio.create_task(
+                            self._agenerate_reflection(
+                                prompt,
+                                snapshot,
+                                reflection_items,
+                                reflection_items_prompt,
+                            )
+                        )
+                first_text = text.getvalue()
+            self._history.append(first_text)
+
+            if await self._askip_reflection(
+                prompt, first_text, reflection_items_prompt, skip_reflection_threshold
+            ):
+                return first_text, None
+
+            if speculation is not None and len(
+                snapshot
+            ) >= SPECULATION_MIN_COVERAGE * len(first_text):
+                reflection = await speculation
+            else:
+                reflection = await self._agenerate_reflection(
+                    prompt, first_text, reflection_items, reflection_items_prompt
+                )
+        finally:
+            # The speculation is not used when the reflection is skipped, the
+            # first text diverged or anything failed or was cancelled.
+            if speculation is not None:
+                speculation.cancel()
+                if speculation.done() and not speculation.cancelled():
+                    speculation.exception()
+        self._history.append(reflection)
+        return first_text, reflection
+
+    def _skip_reflection(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        reflection_items_prompt: str,
+        skip_reflection_threshold: Optional[int],
+    ) -> bool:
+        """
+        Asks the LLM how much the first text needs revision and decides if the
+        reflection can be skipped.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            reflection_items_prompt (str): The prompt for reflection items.
+            skip_reflection_threshold (Optional[int]): The maximum revision rate to skip the
+                reflection, None to never skip it.
+
+        Returns:
+            bool: True if the reflection can be skipped.
+        """
+        if skip_reflection_threshold is None:
+            return False
+
+        response = self._llm_invoke(
+            _build_revision_rate_prompt(
+                prompt.task, reflection_items_prompt, first_text
+            )
+        )
+        return self._record_skip_reflection(response, skip_reflection_threshold)
+
+    async def _askip_reflection(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        reflection_items_prompt: str,
+        skip_reflection_threshold: Optional[int],
+    ) -> bool:
+        if skip_reflection_threshold is None:
+            return False
+
+        response = await self._allm_invoke(
+            _build_revision_rate_prompt(
+                prompt.task, reflection_items_prompt, first_text
+            )
+        )
+        return self._record_skip_reflection(response, skip_reflection_threshold)
+
+    def _record_skip_reflection(
+        self, response: str, skip_reflection_threshold: int
+    ) -> bool:
+        # Anything but a single integer from 1 to 10 (e.g. "On a scale of 1-10,
+        # I'd rate this 8") is not trusted, and the reflection is not skipped.
+        match = _REVISION_RATE_PATTERN.fullmatch(response)
+        if match is None:
+            return False
+
+        revision_rate = int(match.group(1))
+        if not 1 <= revision_rate <= 10 or revision_rate > skip_reflection_threshold:
+            return False
+
+        self._history.append(f"[reflection skipped: revision rate {revision_rate}]")
+        return True
+
+    def _generate_reflection(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        reflection_items_prompt: str,
+    ) -> str:
+        """
+        Generates reflection suggestions from the LLM.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            reflection_items_prompt (str): The prompt for reflection items.
+
+        Returns:
+            str: The reflection suggestions.
+        """
+
+        result = self._llm_invoke(
+            self._build_reflection_prompt(
+                prompt, self._summarize(first_text), reflection_items_prompt
+            )
+        )
+        self._history.append(result)
+        return result
+
+    def _summarize(self, first_text: str) -> str:
+        """
+        Summarizes the first text when it is longer than the summary threshold.
+
+        Args:
+            first_text (str): The first generated text.
+
+        Returns:
+            str: The summary, or the first text when it is short enough.
+        """
+        if not self._needs_summary(first_text):
+            return first_text
+
+        return self._llm_invoke(_build_summary_prompt(first_text))
+
+    async def _asummarize(self, first_text: str) -> str:
+        if not self._needs_summary(first_text):
+            return first_text
+
+        return await self._allm_invoke(_build_summary_prompt(first_text))
+
+    def _needs_summary(self, first_text: str) -> bool:
+        return (
+            self._summary_threshold is not None
+            and len(first_text) > self._summary_threshold
+        )
+
+    async def _agenerate_reflection(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        reflection_items: List,
+        reflection_items_prompt: str,
+    ) -> str:
+        first_text = await self._asummarize(first_text)
+        if reflection_items:
+            return await self._agenerate_reflection_per_items(
+                prompt, first_text, reflection_items
+            )
+
+        return await self._allm_invoke(
+            self._build_reflection_prompt(prompt, first_text, reflection_items_prompt)
+        )
+
+    async def _agenerate_reflection_per_items(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        reflection_items: List,
+    ) -> str:
+        """
+        Generates reflection suggestions with one concurrent LLM call per
+        reflection item.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            reflection_items (List): The reflection items to consider.
+
+        Returns:
+            str: The reflection suggestions of all the items.
+        """
+        suggestions = await asyncio.gather(
+            *[
+                self._allm_invoke(
+                    self._build_reflection_item_prompt(prompt, first_text, item)
+                )
+                for item in reflection_items
+            ]
+        )
+        return "\n".join(suggestions)
+
+    def _build_reflection_prompt(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        reflection_items_prompt: str,
+    ) -> str:
+        """
+        Builds the prompt used to ask the LLM for reflection suggestions.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            reflection_items_prompt (str): The prompt for reflection items.
+
+        Returns:
+            str: The reflection prompt.
+        """
+
+        return "".join(
+            (
+                _reflection_prompt_prefix(
+                    prompt.person, prompt.task, reflection_items_prompt
+                ),
+                _FIRST_RESULT_OPEN,
+                first_text,
+                _FIRST_RESULT_CLOSE,
+                _REFLECTION_CLOSE,
+            )
+        )
+
+    def _build_reflection_item_prompt(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        item: str,
+    ) -> str:
+        """
+        Builds the prompt used to ask the LLM for the suggestions of a single
+        reflection item.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            item (str): The reflection item to consider.
+
+        Returns:
+            str: The single reflection item prompt.
+        """
+
+        return "".join(
+            (
+                _reflection_item_prompt_prefix(prompt.person, prompt.task),
+                _FIRST_RESULT_OPEN,
+                first_text,
+                _FIRST_RESULT_CLOSE,
+                _REFLECTION_ITEM_OPEN,
+                item,
+                _REFLECTION_CLOSE,
+            )
+        )
+
+    def _generate_improve_text(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        expert_suggestions: str,
+        reflection_items_prompt: str,
+    ) -> str:
+        """
+        Generates improved text based on reflection suggestions.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            expert_suggestions (str): The reflection suggestions.
+            reflection_items_prompt (str): The prompt for reflection items.
+
+        Returns:
+            str: The improved text.
+        """
+
+        result = self._llm_invoke(
+            self._build_improve_text_prompt(
+                prompt, first_text, expert_suggestions, reflection_items_prompt
+            ),
+            prompt.response_schema,
+        )
+        self._history.append(result)
+        return result
+
+    async def _agenerate_improve_text(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        expert_suggestions: str,
+        reflection_items_prompt: str,
+    ) -> str:
+        result = await self._allm_invoke(
+            self._build_improve_text_prompt(
+                prompt, first_text, expert_suggestions, reflection_items_prompt
+            ),
+            prompt.response_schema,
+        )
+        self._history.append(result)
+        return result
+
+    def _build_improve_text_prompt(
+        self,
+        prompt: PrompTemplate,
+        first_text: str,
+        expert_suggestions: str,
+        reflection_items_prompt: str,
+    ) -> str:
+        """
+        Builds the prompt used to ask the LLM for the improved text.
+
+        Args:
+            prompt (PrompTemplate): The prompt template to use.
+            first_text (str): The first generated text.
+            expert_suggestions (str): The reflection suggestions.
+            reflection_items_prompt (str): The prompt for reflection items.
+
+        Returns:
+            str: The improve text prompt.
+        """
+
+        return "".join(
+            (
+                _improve_text_prompt_prefix(prompt.task, reflection_items_prompt),
+                _FIRST_RESULT_OPEN,
+                first_text,
+                _EXPERT_SUGGESTIONS_OPEN,
+                expert_suggestions,
+                _IMPROVE_TEXT_CLOSE,
+            )
+        )
+
+    def _llm_invoke_batch(
+        self,
+        prompts: List[str],
+        response_schemas: Optional[List[Optional[Dict[str, Any]]]] = None,
+    ) -> List[str]:
+        """
+        Answers several independent prompts with a single LLM call, falling
+        back to one call per prompt when the response can not be parsed or
+        any prompt has a response schema.
+
+        Args:
+            prompts (List[str]): The prompts to answer.
+            response_schemas (List[Optional[Dict[str, Any]]], optional): The JSON schema of
+                the response of each prompt. Defaults to None.
+
+        Returns:
+            List[str]: The answers, in the order of the prompts.
+        """
+        if response_schemas is not None and any(response_schemas):
+            results = [
+                self._llm_invoke(prompt, response_schema)
+                for prompt, response_schema in zip(prompts, response_schemas)
+            ]
+        elif len(prompts) == 1:
+            results = [self._llm_invoke(prompts[0])]
+        else:
+            results = _parse_batch_answers(
+                self._llm_invoke(_build_batch_prompt(prompts)), len(prompts)
+            ) or [self._llm_invoke(prompt) for prompt in prompts]
+
+        self._history.extend(results)
+        return results
+
+    def clear_cache(self) -> None:
+        """
+        Removes all the responses stored in the cache.
+        """
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _response_cache(self) -> Optional[BaseCache]:
+        return self._cache if self._use_cache else None
+
+    def _llm_invoke(
+        self,
+        prompt: str,
+        response_schema: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        cache = self._response_cache()
+        if cache is None:
+            return self._invoke_provider(prompt, response_schema)
+
+        llm_string = self._cache_llm_string(response_schema)
+        cached = cache.lookup(prompt, llm_string)
+        if cached:
+            return cached[0].text
+
+        result = self._invoke_provider(prompt, response_schema)
+        cache.update(prompt, llm_string, [Generation(text=result)])
+        return result
+
+    async def _allm_invoke(
+        self,
+        prompt: str,
+        response_schema: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        cache = self._response_cache()
+        if cache is None:
+            return await self._ainvoke_provider(prompt, response_schema)
+
+        llm_string = self._cache_llm_string(response_schema)
+        cached = await cache.alookup(prompt, llm_string)
+        if cached:
+            return cached[0].text
+
+        result = await self._ainvoke_provider(prompt, response_schema)
+        await cache.aupdate(prompt, llm_string, [Generation(text=result)])
+        return result
+
+    def _llm_stream(
+        self,
+        prompt: str,
+        response_schema: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        cache = self._response_cache()
+        if cache is None:
+            yield from _guarded_stream(self.llm, prompt, response_schema)
+            return
+
+        llm_string = self._cache_llm_string(response_schema)
+        cached = cache.lookup(prompt, llm_string)
+        if cached:
+            yield cached[0].text
+            return
+
+        result = StringIO()
+        for chunk in _guarded_stream(self.llm, prompt, response_schema):
+            result.write(chunk)
+            yield chunk
+        cache.update(prompt, llm_string, [Generation(text=result.getvalue())])
+
+    async def _allm_stream(
+        self,
+        prompt: str,
+        response_schema: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[str]:
+        cache = self._response_cache()
+        llm_string = self._cache_llm_string(response_schema)
+        if cache is not None:
+            cached = await cache.alookup(prompt, llm_string)
+            if cached:
+                yield cached[0].text
+                return
+
+        result = StringIO()
+        async with _llm_call_limiter():
+            async for chunk in _guarded_astream(self.llm, prompt, response_schema):
+                result.write(chunk)
+                yield chunk
+
+        if cache is not None:
+            await cache.aupdate(
+                prompt, llm_string, [Generation(text=result.getvalue())]
+            )
+
+    def _invoke_provider(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]]
+    ) -> str:
+        breaker = _circuit_breaker(self.llm)
+        try:
+            result: str = Retrying(**self._retry_options())(
+                _guarded_invoke, self.llm, prompt, response_schema
+            )
+        except _RETRYABLE_ERRORS as error:
+            breaker.record_failure(error)
+            raise
+        breaker.record_success()
+        return result
+
+    async def _ainvoke_provider(
+        self, prompt: str, response_schema: Optional[Dict[str, Any]]
+    ) -> str:
+        breaker = _circuit_breaker(self.llm)
+        try:
+            result: str = await AsyncRetrying(**self._retry_options())(
+                _coalesced_ainvoke, self.llm, prompt, response_schema
+            )
+        except _RETRYABLE_ERRORS as error:
+            breaker.record_failure(error)
+            raise
+        breaker.record_success()
+        return result
+
+    def _retry_options(self) -> Dict[str, Any]:
+        """
+        Returns the options of the retries of the transient provider errors,
+        with jittered exponential backoff. Each retry is recorded in the history.
+
+        Returns:
+            Dict[str, Any]: The tenacity retry options.
+        """
+        return {
+            "wait": wait_random_exponential(min=0.5, max=8),
+            "stop": stop_after_attempt(RETRY_ATTEMPTS),
+            "retry": retry_if_exception_type(_RETRYABLE_ERRORS),
+            "before_sleep": self._record_retry,
+            "reraise": True,
+        }
+
+    def _record_retry(self, retry_state: RetryCallState) -> None:
+        if retry_state.outcome is None:
+            return
+        error = retry_state.outcome.exception()
+        logger.info("retrying LLM call after %r", error)
+        self._history.append(
+            f"[retry {retry_state.attempt_number}: {type(error).__name__}]"
+        )
+
+    def _cache_llm_string(self, response_schema: Optional[Dict[str, Any]]) -> str:
+        schema_key = _schema_key(response_schema)
+        if schema_key is None:
+            return self._llm_string
+        return f"{self._llm_string}|{schema_key}"